@@ -1,14 +1,26 @@
 #!/usr/bin/env python3
 import os
-import pickle
 import argparse
+import asyncio
 import openai
-import json
+import httpx
+import orjson
 import csv
+import hashlib
+import sqlite3
 from datetime import datetime
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+
+# scikit-learn is optional; without it every email goes to OpenAI.
+try:
+    from sklearn.feature_extraction.text import HashingVectorizer
+    from sklearn.linear_model import LogisticRegression
+except ImportError:
+    HashingVectorizer = None
+    LogisticRegression = None
 
 # Gmail API scope
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
@@ -19,39 +31,114 @@ TARGET_LABELS = ["Interactions", "Advertisements", "Notices", "Documents", "Appo
 # Gmail system labels to skip
 SKIP_LABELS = ["Promotions", "Social", "Updates"]
 
+# Gmail search query for messages without user labels, excluding the skipped system labels
+UNCATEGORIZED_QUERY = "has:nouserlabels " + " ".join(f"-label:{lbl}" for lbl in SKIP_LABELS)
+
+# Max message IDs per Gmail messages.list page
+LIST_PAGE_SIZE = 500
+
 # CSV log file
 LOG_FILE = "classification_log.csv"
+LOG_FIELDNAMES = ["Mail ID", "Mail Title", "Summary", "Category", "Timestamp"]
+
+# Max requests per Gmail batch HTTP request (Gmail recommends no more than 50)
+BATCH_SIZE = 50
+
+# Max message IDs per Gmail batchModify request
+BATCH_MODIFY_SIZE = 1000
+
+# SQLite cache of previous classifications
+CACHE_FILE = "classification_cache.db"
+
+# Local classifier: logged LLM classifications needed to train it, and the
+# confidence it needs to skip the OpenAI call
+LOCAL_MIN_SAMPLES = 200
+LOCAL_CONFIDENCE = 0.85
+
+# OpenAI API key (leave empty to fall back to the OPENAI_API_KEY environment variable)
+OPENAI_API_KEY = ""
+
+# OpenAI model used for classification
+MODEL = "gpt-4o-mini"
+
+# Default number of emails processed concurrently
+CONCURRENCY = 20
+
+# Max characters of email content sent to OpenAI
+MAX_CONTENT_CHARS = 1500
+
+# Classification instructions, kept constant so every request shares the same prompt prefix
+SYSTEM_PROMPT = """You are an email categorization assistant. Follow these instructions carefully:
+
+Step 1: Provide a very short summary (within 10 tokens) of the email.
+
+Step 2: Classify the email into exactly ONE of these labels: Appointments, Documents, Interactions, Notices, Advertisements, or Et Cetera.
+
+Rules (in strict priority order):
+1. Appointments: Label as "Appointments" if the email mentions scheduling or an event date/time (this has absolute priority).
+2. Documents: Label as "Documents" if the email contains or refers to any attachments, files, documents, or external resources (unless it explicitly involves scheduling an event—then it must be "Appointments").
+3. Interactions: Label as "Interactions" only if the email is a conversation or direct interaction between people/entities (excluding scheduling).
+4. Notices: Label as "Notices" if the email primarily provides informational updates without direct conversation or personal interaction, but is not promotional.
+5. Advertisements: Label as "Advertisements" only if the email is promotional, a newsletter, subscription-based, or marketing material.
+6. Et Cetera: Label as "Et Cetera" only if the email clearly does NOT fit any of the above categories.
+
+Additional Instructions:
+- Follow the priority strictly. For example, emails with attachments must always be labeled as "Documents" unless explicitly about scheduling (then "Appointments").
+- If the email content is in Korean, double-check carefully. Do NOT guess; ensure accuracy in classification based on these rules.
+- Report your answer by calling the "classify" function with the summary and category.
+
+The email to classify follows in the next message."""
+
+# Function the model must call to report its classification
+CLASSIFY_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "classify",
+        "description": "Report the summary and category of the email.",
+        "strict": True,
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "summary": {"type": "string"},
+                "category": {"type": "string", "enum": TARGET_LABELS}
+            },
+            "required": ["summary", "category"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# Version of the classification setup; changing the model, prompt or labels invalidates cached results
+CACHE_VERSION = hashlib.blake2b(
+    MODEL.encode("utf-8") + b"\x00" + SYSTEM_PROMPT.encode("utf-8") + b"\x00" + orjson.dumps(CLASSIFY_TOOL),
+    digest_size=8
+).hexdigest()
 
 def get_gmail_service():
     """
     Authenticate with the Gmail API and return a service object.
-    Uses token.pickle to store/reuse credentials.
+    Uses token.json to store/reuse credentials.
     """
     creds = None
-    if os.path.exists("token.pickle"):
-        with open("token.pickle", "rb") as token:
-            creds = pickle.load(token)
+    if os.path.exists("token.json"):
+        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
         else:
             flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
             creds = flow.run_local_server(port=0)
-        with open("token.pickle", "wb") as token:
-            pickle.dump(creds, token)
+        with open("token.json", "w", encoding="utf-8") as token:
+            token.write(creds.to_json())
     service = build("gmail", "v1", credentials=creds)
     return service
 
-def get_existing_label(service, label_name):
+def get_label_lookup(service):
     """
-    Retrieve the label ID for a given label name without creating it.
+    Return a dictionary mapping all existing label names (in lowercase) to their IDs.
     """
     results = service.users().labels().list(userId="me").execute()
-    labels = results.get("labels", [])
-    for label in labels:
-        if label["name"].lower() == label_name.lower():
-            return label["id"]
-    return None
+    return {label["name"].lower(): label["id"] for label in results.get("labels", [])}
 
 def create_label(service, label_name):
     """
@@ -70,37 +157,94 @@ def initialize_target_labels(service):
     Ensure that all target labels exist.
     Return a dictionary mapping label names (in lowercase) to their IDs.
     """
+    # Fetch the label list once instead of once per target label.
+    existing = get_label_lookup(service)
     label_mapping = {}
     for label in TARGET_LABELS:
-        label_id = get_existing_label(service, label)
+        label_id = existing.get(label.lower())
         if label_id is None:
             label_id = create_label(service, label)
         label_mapping[label.lower()] = label_id
     return label_mapping
 
-def append_log(mail_id, mail_title, summary, category):
+def append_log(writer, mail_id, mail_title, summary, category):
     """
-    Append a CSV log entry for the classified email.
+    Append a CSV log entry for the classified email using the given csv writer.
     The log includes Mail ID, Mail Title, Summary, Category, and Timestamp.
     """
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    file_exists = os.path.exists(LOG_FILE)
-    with open(LOG_FILE, mode="a", newline="", encoding="utf-8") as csvfile:
-        fieldnames = ["Mail ID", "Mail Title", "Summary", "Category", "Timestamp"]
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        if not file_exists:
-            writer.writeheader()
-        writer.writerow({
-            "Mail ID": mail_id,
-            "Mail Title": mail_title,
-            "Summary": summary,
-            "Category": category,
-            "Timestamp": timestamp
-        })
-
-def classify_email_with_chatgpt(mail_title, email_content):
-    """
-    Use the latest OpenAI API with model "gpt-4o-mini" to classify the email.
+    writer.writerow((mail_id, mail_title, summary, category, timestamp))
+
+def open_classification_cache():
+    """
+    Open (creating if needed) the SQLite cache of previous classifications.
+    """
+    cache = sqlite3.connect(CACHE_FILE)
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS classifications "
+        "(key TEXT PRIMARY KEY, summary TEXT NOT NULL, category TEXT NOT NULL)"
+    )
+    return cache
+
+def classification_cache_key(mail_title, email_content):
+    """
+    Hash the mail title and content, along with CACHE_VERSION, into a cache key.
+    """
+    data = f"{CACHE_VERSION}\x00{mail_title}\x00{email_content}".encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def get_cached_classification(cache, mail_title, email_content):
+    """
+    Return the cached classification for the mail title and content (cut to
+    MAX_CONTENT_CHARS, as sent to OpenAI), or None if it has not been classified yet.
+    """
+    key = classification_cache_key(mail_title, email_content[:MAX_CONTENT_CHARS])
+    row = cache.execute("SELECT summary, category FROM classifications WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return None
+    return {"summary": row[0], "category": row[1]}
+
+def train_local_classifier():
+    """
+    Train a local classifier on the mail titles in the classification log.
+    Only rows classified by OpenAI (those with a summary) are used, so the local
+    model never learns from its own guesses.
+    Return a (vectorizer, model) tuple, or None if scikit-learn is missing or
+    there is not enough data yet.
+    """
+    if LogisticRegression is None or not os.path.exists(LOG_FILE):
+        return None
+    titles, categories = [], []
+    with open(LOG_FILE, newline="", encoding="utf-8") as csvfile:
+        for row in csv.DictReader(csvfile):
+            if row.get("Summary") and row.get("Mail Title"):
+                titles.append(row["Mail Title"])
+                categories.append(row["Category"])
+    if len(titles) < LOCAL_MIN_SAMPLES or len(set(categories)) < 2:
+        return None
+    vectorizer = HashingVectorizer(n_features=2**18)
+    model = LogisticRegression(max_iter=1000)
+    model.fit(vectorizer.transform(titles), categories)
+    print(f"Trained local classifier on {len(titles)} logged classifications.")
+    return vectorizer, model
+
+def classify_locally(local_classifier, mail_title):
+    """
+    Return the local classifier's category for the mail title if it is
+    confident enough, otherwise None.
+    """
+    if local_classifier is None or not mail_title:
+        return None
+    vectorizer, model = local_classifier
+    proba = model.predict_proba(vectorizer.transform([mail_title]))[0]
+    best = proba.argmax()
+    if proba[best] > LOCAL_CONFIDENCE:
+        return str(model.classes_[best])
+    return None
+
+async def classify_email_with_chatgpt(client, cache, mail_title, email_content):
+    """
+    Use the latest OpenAI API with MODEL ("gpt-4o-mini") to classify the email.
     
     The LLM prompt instructs:
       - First, provide a very short summary (within 10 tokens) of the email.
@@ -113,87 +257,67 @@ def classify_email_with_chatgpt(mail_title, email_content):
           • Advertisements: For promotional material, newsletters, or subscriptions.
           • Notices: If the email is similar to Advertisements but is more about conveying information than promotion, label it as Notices.
           • Et Cetera: For emails that don’t clearly fall under any of the above.
-      - Output the answer as a JSON object with keys "summary" and "category" (no extra text).
-    """
-    openai.api_key = ""
-    prompt = (
-        """
-        You are an email categorization assistant. Follow these instructions carefully:
-
-        Step 1: Provide a very short summary (within 10 tokens) of the email.
-
-        Step 2: Classify the email into exactly ONE of these labels: Appointments, Documents, Interactions, Notices, Advertisements, or Et Cetera.
-
-        Rules (in strict priority order):
-        1. Appointments: Label as "Appointments" if the email mentions scheduling or an event date/time (this has absolute priority).
-        2. Documents: Label as "Documents" if the email contains or refers to any attachments, files, documents, or external resources (unless it explicitly involves scheduling an event—then it must be "Appointments").
-        3. Interactions: Label as "Interactions" only if the email is a conversation or direct interaction between people/entities (excluding scheduling).
-        4. Notices: Label as "Notices" if the email primarily provides informational updates without direct conversation or personal interaction, but is not promotional.
-        5. Advertisements: Label as "Advertisements" only if the email is promotional, a newsletter, subscription-based, or marketing material.
-        6. Et Cetera: Label as "Et Cetera" only if the email clearly does NOT fit any of the above categories.
-
-        Additional Instructions:
-        - Follow the priority strictly. For example, emails with attachments must always be labeled as "Documents" unless explicitly about scheduling (then "Appointments").
-        - If the email content is in Korean, double-check carefully. Do NOT guess; ensure accuracy in classification based on these rules.
-        - Output your answer strictly as a JSON object with exactly two keys: "summary" and "category". Do not include any extra text.
-
-        Here is the email to classify:\n
-        """
-        f"Mail Title: {mail_title}\n"
-        f"Email Content:\n{email_content}"
-        
-    )
+      - Report the answer by calling the "classify" function with "summary" and "category".
+
+    Results are stored in the cache by mail title and content, so identical emails
+    can skip the API call later (see get_cached_classification).
+    The email content is cut to MAX_CONTENT_CHARS to bound the cost of each call.
+    """
+    email_content = email_content[:MAX_CONTENT_CHARS]
+    key = classification_cache_key(mail_title, email_content)
+
     messages = [
-        {"role": "system", "content": "You are an email categorization assistant."},
-        {"role": "user", "content": prompt}
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"Mail Title: {mail_title}\nEmail Content:\n{email_content}"}
     ]
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",
+        response = await client.chat.completions.create(
+            model=MODEL,
             messages=messages,
             temperature=0.0,
-            max_tokens=100,
+            max_tokens=60,
+            tools=[CLASSIFY_TOOL],
+            tool_choice={"type": "function", "function": {"name": "classify"}},
         )
-        response_text = response.choices[0].message.content.strip()
-        result = json.loads(response_text)
-        if "summary" in result and "category" in result:
-            category = result["category"].strip()
-            # If the returned category is not one of our target labels, default to "Et Cetera".
-            if category.lower() not in [lbl.lower() for lbl in TARGET_LABELS]:
-                category = "Et Cetera"
-            result["category"] = category
-            return result
-        else:
-            print("LLM response did not contain required keys.")
-            return None
+        # The strict schema guarantees both keys and a category from TARGET_LABELS.
+        tool_call = response.choices[0].message.tool_calls[0]
+        result = orjson.loads(tool_call.function.arguments)
+        cache.execute(
+            "INSERT OR REPLACE INTO classifications (key, summary, category) VALUES (?, ?, ?)",
+            (key, result["summary"], result["category"])
+        )
+        cache.commit()
+        return result
     except Exception as e:
         print(f"Error during OpenAI API call: {e}")
         return None
 
-def get_uncategorized_messages(service):
+def get_uncategorized_messages(service, limit=None):
     """
     Retrieve messages that have no user-applied labels (has:nouserlabels)
     and skip messages with Gmail's system labels (Promotions, Social, Updates).
-    Then sort messages by newest first.
-    """
-    query = "has:nouserlabels " + " ".join([f"-label:{lbl}" for lbl in SKIP_LABELS])
-    results = service.users().messages().list(userId="me", q=query).execute()
-    messages = results.get("messages", [])
-    detailed_messages = []
-    for msg in messages:
-        m = service.users().messages().get(userId="me", id=msg["id"], format="metadata").execute()
-        internal_date = int(m.get("internalDate", 0))
-        detailed_messages.append({"id": msg["id"], "internalDate": internal_date})
-    detailed_messages.sort(key=lambda x: x["internalDate"], reverse=True)
-    sorted_messages = [{"id": m["id"]} for m in detailed_messages]
-    return sorted_messages
-
-def process_message(service, msg_id, label_mapping):
-    """
-    For a given Gmail message ID, retrieve its content, classify it using OpenAI,
-    apply the corresponding label, and log the classification.
+    Gmail already returns these newest first, so no extra sorting is needed.
+    If `limit` is given, stop once that many messages have been retrieved.
+    """
+    messages = []
+    page_token = None
+    while limit is None or len(messages) < limit:
+        page_size = LIST_PAGE_SIZE if limit is None else min(LIST_PAGE_SIZE, limit - len(messages))
+        results = service.users().messages().list(
+            userId="me", q=UNCATEGORIZED_QUERY, maxResults=page_size,
+            fields="messages/id,nextPageToken", pageToken=page_token
+        ).execute()
+        messages.extend(results.get("messages", []))
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            break
+    return messages
+
+def parse_message_content(message):
+    """
+    From a Gmail message metadata response, extract its mail title (subject) and
+    the content to classify.
     """
-    message = service.users().messages().get(userId="me", id=msg_id, format="full").execute()
     payload = message.get("payload", {})
     
     # Extract mail title (subject)
@@ -206,11 +330,45 @@ def process_message(service, msg_id, label_mapping):
     snippet = message.get("snippet", "")
     email_content = f"Subject: {mail_title}\nSnippet: {snippet}"
     
-    result = classify_email_with_chatgpt(mail_title, email_content)
-    if result is None:
-        print(f"Could not classify message {msg_id}. Skipping.")
-        return
-    
+    return {
+        "id": message["id"],
+        "title": mail_title,
+        "content": email_content
+    }
+
+def get_messages_content(service, msg_ids):
+    """
+    Retrieve the content of the given Gmail messages, BATCH_SIZE gets per HTTP request.
+    Return the parsed messages in the order of `msg_ids`, skipping duplicates and any
+    that failed to fetch.
+    """
+    # Batch request IDs must be unique, and an ID can repeat across list pages.
+    msg_ids = list(dict.fromkeys(msg_ids))
+    contents = {}
+
+    def _cb(request_id, response, exception):
+        if exception is not None:
+            print(f"Could not fetch message {request_id}: {exception}. Skipping.")
+            return
+        contents[request_id] = parse_message_content(response)
+
+    for i in range(0, len(msg_ids), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=_cb)
+        for msg_id in msg_ids[i:i + BATCH_SIZE]:
+            # Only the Subject header and snippet are needed, so skip the body.
+            batch.add(service.users().messages().get(
+                userId="me", id=msg_id, format="metadata", metadataHeaders=["Subject"],
+                fields="id,snippet,payload/headers"
+            ), request_id=msg_id)
+        batch.execute()
+    return [contents[msg_id] for msg_id in msg_ids if msg_id in contents]
+
+def queue_classification(msg, result, label_mapping, to_label):
+    """
+    Queue the label for a classification result to be applied to a message.
+    `to_label` maps label IDs to the (message, summary, category) entries awaiting that label.
+    """
+    msg_id = msg["id"]
     summary = result.get("summary", "").strip()
     category = result.get("category", "").strip()
     
@@ -220,43 +378,115 @@ def process_message(service, msg_id, label_mapping):
         print(f"Label '{category}' not found. Skipping message {msg_id}.")
         return
     
-    # If the message already has this label, skip it.
-    current_labels = message.get("labelIds", [])
-    if label_id in current_labels:
-        print(f"Message {msg_id} already labeled as {category}. Skipping.")
-        return
+    to_label.setdefault(label_id, []).append((msg, summary, category))
+
+def apply_labels(service, to_label, log_writer):
+    """
+    Apply the queued labels using batchModify, one request per label and up to
+    BATCH_MODIFY_SIZE messages, and log each classification.
+    """
+    for label_id, entries in to_label.items():
+        for i in range(0, len(entries), BATCH_MODIFY_SIZE):
+            chunk = entries[i:i + BATCH_MODIFY_SIZE]
+            body = {"ids": [msg["id"] for msg, _, _ in chunk], "addLabelIds": [label_id]}
+            service.users().messages().batchModify(userId="me", body=body).execute()
+            
+            for msg, summary, category in chunk:
+                print(f"Message {msg['id']} categorized as {category}.")
+                append_log(log_writer, msg["id"], msg["title"], summary, category)
+
+async def process_messages(service, messages, label_mapping, log_writer, concurrency):
+    """
+    Retrieve the content of each message, classify it (from the cache, then the
+    local classifier when it is confident, with an empty summary, then OpenAI),
+    apply the corresponding label, and log the classification.
+    Messages with identical title and content are classified only once, with at
+    most `concurrency` classifications in flight at once. Labels are applied in
+    bulk once every message has been classified.
+    """
+    # Group messages sharing the same title and content.
+    unique = {}
+    for content in get_messages_content(service, [msg["id"] for msg in messages]):
+        key = classification_cache_key(content["title"], content["content"])
+        unique.setdefault(key, []).append(content)
     
-    # Apply the label to the message.
-    msg_labels = {"addLabelIds": [label_id]}
-    service.users().messages().modify(userId="me", id=msg_id, body=msg_labels).execute()
-    print(f"Message {msg_id} categorized as {category}.")
+    # Size the keep-alive pool to the concurrency so connections are reused, not re-handshaked.
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    client = openai.AsyncOpenAI(
+        api_key=OPENAI_API_KEY or None,
+        http_client=openai.DefaultAsyncHttpxClient(limits=limits)
+    )
+    cache = open_classification_cache()
+    local_classifier = train_local_classifier()
+    semaphore = asyncio.Semaphore(concurrency)
+    to_label = {}
+
+    async def _run(group):
+        title, content = group[0]["title"], group[0]["content"]
+        # Cached OpenAI results first, then the local classifier, then OpenAI.
+        result = get_cached_classification(cache, title, content)
+        if result is None:
+            category = classify_locally(local_classifier, title)
+            if category is not None:
+                result = {"summary": "", "category": category}
+        if result is None:
+            async with semaphore:
+                result = await classify_email_with_chatgpt(client, cache, title, content)
+        for msg in group:
+            if result is None:
+                print(f"Could not classify message {msg['id']}. Skipping.")
+            else:
+                queue_classification(msg, result, label_mapping, to_label)
+
+    try:
+        await asyncio.gather(*(_run(group) for group in unique.values()))
+    finally:
+        cache.close()
+        await client.close()
     
-    # Log the classification.
-    append_log(msg_id, mail_title, summary, category)
+    apply_labels(service, to_label, log_writer)
+
+def positive_int(value):
+    """
+    argparse type for options that must be a whole number of at least 1.
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
 
 def main():
     parser = argparse.ArgumentParser(
         description="Classify Gmail emails into Interactions, Advertisements, Notices, Documents, Appointments, or Et Cetera."
     )
     parser.add_argument(
-        "--count", type=int, default=None,
+        "--count", type=positive_int, default=None,
         help="Number of emails to process in one execution. Default processes all eligible emails."
     )
+    parser.add_argument(
+        "--concurrency", type=positive_int, default=CONCURRENCY,
+        help=f"Number of emails to process concurrently. Default is {CONCURRENCY}."
+    )
     args = parser.parse_args()
     
     service = get_gmail_service()
     # Ensure all target labels exist.
     label_mapping = initialize_target_labels(service)
-    messages = get_uncategorized_messages(service)
+    messages = get_uncategorized_messages(service, args.count)
     
     if not messages:
         print("No eligible messages found.")
         return
     
     print(f"Found {len(messages)} eligible messages (newest first).")
-    count = args.count if args.count is not None else len(messages)
-    for msg in messages[:count]:
-        process_message(service, msg["id"], label_mapping)
+    
+    # Open the log once for the whole run rather than once per message.
+    file_exists = os.path.exists(LOG_FILE)
+    with open(LOG_FILE, mode="a", newline="", encoding="utf-8", buffering=1 << 16) as csvfile:
+        log_writer = csv.writer(csvfile)
+        if not file_exists:
+            log_writer.writerow(LOG_FIELDNAMES)
+        asyncio.run(process_messages(service, messages, label_mapping, log_writer, args.concurrency))
 
 if __name__ == "__main__":
     main()